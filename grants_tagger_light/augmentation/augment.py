@@ -1,13 +1,15 @@
 import json
-import multiprocessing
 import os
 
+import pyarrow.compute as pc
 import typer
 from loguru import logger
-import numpy as np
 
 
-from grants_tagger_light.augmentation.augment_openai import AugmentOpenAI
+from grants_tagger_light.augmentation.augment_openai import (
+    AugmentOpenAI,
+    build_tags_index,
+)
 
 from datasets import load_from_disk
 
@@ -19,27 +21,6 @@ from grants_tagger_light.utils.years_tags_parser import parse_tags
 augment_app = typer.Typer()
 
 
-def _count_elements_in_sublist(sublist):
-    element_count = {}
-    for element in sublist:
-        if element in element_count:
-            element_count[element] += 1
-        else:
-            element_count[element] = 1
-    return element_count
-
-
-def _merge_dicts(dict_list):
-    merged_dict = {}
-    for d in dict_list:
-        for key, value in d.items():
-            if key in merged_dict:
-                merged_dict[key] += value
-            else:
-                merged_dict[key] = value
-    return merged_dict
-
-
 def augment(
     data_path: str,
     save_to_path: str,
@@ -53,6 +34,11 @@ def augment(
     temperature: float = 1.5,
     tags: list = None,
     tags_file_path: str = None,
+    n_per_request: int = 5,
+    max_concurrent: int = None,
+    max_rpm: int = 3500,
+    max_tpm: int = 90000,
+    cache_path: str = None,
 ):
     if model_key.strip().lower() not in ["gpt-3.5-turbo", "text-davinci", "gpt-4"]:
         raise NotImplementedError(
@@ -64,16 +50,20 @@ def augment(
         dset = dset["train"]
 
     logger.info("Obtaining count values from the labels...")
-    pool = multiprocessing.Pool(processes=num_proc)
-    element_counts_list = pool.map(_count_elements_in_sublist, dset["meshMajor"])
-    pool.close()
-    pool.join()
-
-    merged_element_counts = _merge_dicts(element_counts_list)
-    sorted_merged_element_counts = sorted(
-        merged_element_counts.items(), key=lambda x: x[1], reverse=True
+    # Counted on the Arrow column, without converting `meshMajor` to Python lists
+    merged_element_counts = pc.value_counts(
+        pc.list_flatten(dset.with_format("arrow")["meshMajor"])
+    )
+    sorted_merged_element_counts_dict = dict(
+        sorted(
+            zip(
+                merged_element_counts.field("values").to_pylist(),
+                merged_element_counts.field("counts").to_pylist(),
+            ),
+            key=lambda x: x[1],
+            reverse=True,
+        )
     )
-    sorted_merged_element_counts_dict = dict(sorted_merged_element_counts)
 
     print(f"Tags: {tags}")
     if tags is None:
@@ -134,35 +124,49 @@ def augment(
 
     logger.info("Collecting existing examples of those tags to send in the prompt")
 
+    tags_to_augment_set = set(tags_to_augment)
     dset = dset.filter(
-        lambda x: any(np.isin(tags_to_augment, x["meshMajor"])), num_proc=num_proc
-    )
-
-    dset = dset.map(
-        lambda _, y: {"idx": y},
-        with_indices=True,
+        lambda x: [not tags_to_augment_set.isdisjoint(t) for t in x["meshMajor"]],
         batched=True,
         batch_size=batch_size,
-        desc="Creating idx",
+        desc="Filtering rows with tags to augment",
         num_proc=num_proc,
     )
 
+    logger.info("Indexing the rows of each tag...")
+    tags_index = build_tags_index(dset)
+
     if concurrent_calls == 1:
-        openai = AugmentOpenAI
+        openai = AugmentOpenAI(
+            prompt_template_path=prompt_template,
+            model_key=model_key,
+            n_per_request=n_per_request,
+            cache_path=cache_path,
+        )
     else:
-        openai = ParallelAugmentOpenAI
+        openai = ParallelAugmentOpenAI(
+            prompt_template_path=prompt_template,
+            model_key=model_key,
+            n_per_request=n_per_request,
+            max_concurrent=concurrent_calls
+            if max_concurrent is None
+            else max_concurrent,
+            max_rpm=max_rpm,
+            max_tpm=max_tpm,
+            cache_path=cache_path,
+        )
 
     collect_concurrent_calls = []
 
     for t in tags_to_augment:
         if len(collect_concurrent_calls) >= concurrent_calls:
-            openai(prompt_template_path=prompt_template, model_key=model_key).generate(
+            openai.generate(
                 collect_concurrent_calls,
                 dset,
                 save_to_path,
                 model_key,
                 temperature=temperature,
-                num_proc=num_proc,
+                tags_index=tags_index,
             )
             collect_concurrent_calls = []
         else:
@@ -170,15 +174,17 @@ def augment(
 
     # Remaining rows of the last batch
     if len(collect_concurrent_calls) > 0:
-        openai(prompt_template_path=prompt_template, model_key=model_key).generate(
+        openai.generate(
             collect_concurrent_calls,
             dset,
             save_to_path,
             model_key,
             temperature=temperature,
-            num_proc=num_proc,
+            tags_index=tags_index,
         )
 
+    openai.close()
+
 
 @augment_app.command()
 def augment_cli(
@@ -223,6 +229,29 @@ def augment_cli(
         help="Text file containing one line per tag to be considered. "
         "The rest will be discarded.",
     ),
+    n_per_request: int = typer.Option(
+        5,
+        min=1,
+        help="Examples to generate in each call to the model, "
+        "using the same existing example in the prompt",
+    ),
+    max_concurrent: int = typer.Option(
+        None,
+        min=1,
+        help="Maximum number of requests in flight to OpenAI. "
+        "Defaults to `concurrent-calls`",
+    ),
+    max_rpm: int = typer.Option(
+        3500, min=1, help="Maximum number of requests per minute sent to OpenAI"
+    ),
+    max_tpm: int = typer.Option(
+        90000, min=1, help="Maximum number of tokens per minute sent to OpenAI"
+    ),
+    cache_path: str = typer.Option(
+        None,
+        help="Path to a sqlite file to cache the responses of the model, "
+        "so that re-running the augmentation does not send the same requests again",
+    ),
 ):
     if not os.path.isdir(data_path):
         logger.error(
@@ -259,4 +288,9 @@ def augment_cli(
         temperature=temperature,
         tags=parse_tags(tags),
         tags_file_path=tags_file_path,
+        n_per_request=n_per_request,
+        max_concurrent=max_concurrent,
+        max_rpm=max_rpm,
+        max_tpm=max_tpm,
+        cache_path=cache_path,
     )
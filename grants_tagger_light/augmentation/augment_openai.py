@@ -2,18 +2,82 @@ import datetime
 import json
 import math
 import os
+import queue
+import random
+import threading
+import time
 import uuid
 
+import numpy as np
 import openai
+import orjson
+import pyarrow.compute as pc
 
 from loguru import logger
-import numpy as np
 
 from grants_tagger_light.augmentation.JsonParser import JsonParser
+from grants_tagger_light.augmentation.response_cache import ResponseCache
+
+# Transient errors (rate limits, timeouts, connection issues, overloaded servers)
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+
+def is_retryable(error):
+    """Transient errors, plus the 5xx (or unknown status) `APIError`s: openai
+    only raises `ServiceUnavailableError` for 503, and `APIError` for 500/502"""
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    return isinstance(error, openai.error.APIError) and (
+        error.http_status is None or error.http_status >= 500
+    )
+
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+# The writer thread flushes every `WRITE_BATCH_SIZE` records, or when it did not
+# receive new records for `WRITE_FLUSH_INTERVAL` seconds
+WRITE_BATCH_SIZE = 100
+WRITE_FLUSH_INTERVAL = 0.05
+
+
+def build_tags_index(dset):
+    """Builds an inverted index `tag -> [row positions in dset]` in a single pass,
+    so that examples of a tag can be retrieved with `dset.select` instead of
+    filtering the whole dataset once per tag.
+
+    The groups are computed on the Arrow column, so `meshMajor` is never
+    converted to Python lists."""
+    mesh_major = dset.with_format("arrow")["meshMajor"].combine_chunks()
+    tags = pc.list_flatten(mesh_major).dictionary_encode()
+    rows = pc.list_parent_indices(mesh_major).to_numpy()
+    codes = tags.indices.to_numpy()
+    # Stable, so the rows of each tag keep the order they have in `dset`
+    order = np.argsort(codes, kind="stable")
+    counts = np.bincount(codes, minlength=len(tags.dictionary))
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    return {
+        tag: rows[order[start:end]].tolist()
+        for tag, start, end in zip(tags.dictionary.to_pylist(), starts, ends)
+    }
 
 
 class AugmentOpenAI:
-    def __init__(self, prompt_template_path, model_key="gpt-3.5-turbo"):
+    def __init__(
+        self,
+        prompt_template_path,
+        model_key="gpt-3.5-turbo",
+        n_per_request=5,
+        max_attempts=3,
+        base_backoff=1,
+        max_backoff=30,
+        cache_path=None,
+    ):
         if "OPENAI_API_KEY" not in os.environ:
             logger.error(
                 "OPENAI_API_KEY not found in env vars. "
@@ -21,56 +85,188 @@ class AugmentOpenAI:
             )
         with open(prompt_template_path, "r") as f:
             self.prompt_template = f.read()
+        for placeholder in ("{TOPIC}", "{ABSTRACT}"):
+            if placeholder not in self.prompt_template:
+                raise ValueError(
+                    f"{placeholder} not found in the prompt template "
+                    f"{prompt_template_path}"
+                )
         self.model_key = model_key
+        self.n_per_request = n_per_request
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.cache = ResponseCache(cache_path) if cache_path is not None else None
 
-    def _create_message(self, abstract, tag):
-        prompt = self.prompt_template.replace("{TOPIC}", tag)
-        prompt = prompt.replace("{ABSTRACT}", abstract)
+        # The output is written by a background thread, so that the requests
+        # don't wait for the disk
+        self._writer_q = queue.Queue()
+        self._writer_error = None
+        self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer_thread.start()
 
-        return [{"role": "user", "content": prompt}]
+    def _create_tag_prompt(self, tag):
+        return self.prompt_template.replace("{TOPIC}", tag)
+
+    @staticmethod
+    def _create_message(tag_prompt, abstract):
+        """`tag_prompt` is the template with the tag already in it (see
+        `_create_tag_prompt`), as it's the same for all the examples of a tag"""
+        return [{"role": "user", "content": tag_prompt.replace("{ABSTRACT}", abstract)}]
+
+    def _backoff(self, attempt):
+        """Exponential backoff (1s -> 2s -> 4s...) with jitter,
+        so that concurrent retries are not sent all at the same time"""
+        return min(self.max_backoff, self.base_backoff * 2**attempt) + random.uniform(
+            0, 0.5
+        )
+
+    def _process_cached_response(self, data, metadata):
+        """Returns the key of the request in the cache (if any) and whether
+        a cached response was found, in which case it is processed"""
+        if self.cache is None:
+            return None, False
+        key = self.cache.key(data)
+        choices = self.cache.get(key)
+        if choices is None:
+            return key, False
+        logger.info(f"Cached response found for {metadata['featured_tag']}")
+        self.process_choices(choices, metadata)
+        return key, True
+
+    def _cache_response(self, key, chat_completion):
+        if self.cache is not None:
+            self.cache.set(key, chat_completion["choices"])
+
+    @staticmethod
+    def _save_failed_request(data, metadata, error):
+        logger.warning(
+            f"Failed to get augmentation for {metadata['featured_tag']}: {error}"
+        )
+        with open(f"{metadata['save_to_path']}.failed", "a") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "featured_tag": metadata["featured_tag"],
+                        "error": str(error),
+                        "data": data,
+                    }
+                )
+            )
+            f.write("\n")
 
     @staticmethod
     def _parse_response(answer, metadata):
         print(json.dumps(answer, indent=2))
-        with open(metadata["save_to_path"], "a") as f:
-            try:
-                json_response = JsonParser.parse_json(answer)
-            except Exception as e:
-                logger.info(f"Error processing output: {e}. Skipping...")
-                return
-
-            res = {
-                "journal": metadata["model_key"],
-                "meshMajor": metadata["tags"],
-                "year": metadata["year"],
-                "abstractText": json_response["abstract"]
-                .replace("'", "")
-                .replace('"', ""),
-                "pmid": uuid.uuid4().hex,
-                "title": json_response["title"].replace("'", "").replace('"', ""),
-                "existing_example": metadata["existing_example"]
-                .replace("'", "")
-                .replace('"', ""),
-                "required_examples": metadata["required_examples"],
-                "featured_tag": metadata["featured_tag"],
-            }
+        try:
+            json_response = JsonParser.parse_json(answer)
+        except Exception as e:
+            logger.info(f"Error processing output: {e}. Skipping...")
+            return None
 
-            f.write(json.dumps(res))
-            f.write("\n")
-            f.flush()
+        return {
+            "journal": metadata["model_key"],
+            "meshMajor": metadata["tags"],
+            "year": metadata["year"],
+            "abstractText": json_response["abstract"].replace("'", "").replace('"', ""),
+            "pmid": uuid.uuid4().hex,
+            "title": json_response["title"].replace("'", "").replace('"', ""),
+            "existing_example": metadata["existing_example"]
+            .replace("'", "")
+            .replace('"', ""),
+            "required_examples": metadata["required_examples"],
+            "featured_tag": metadata["featured_tag"],
+        }
 
-            logger.info(f"Data received successfully for {metadata['featured_tag']}")
+    def _writer_loop(self):
+        """Consumes the queue of `(save_to_path, rows)`. A `threading.Event` asks
+        to flush everything written so far, and `None` to stop"""
+        files = {}
+        pending = 0
+        try:
+            while True:
+                try:
+                    item = self._writer_q.get(
+                        timeout=WRITE_FLUSH_INTERVAL if pending > 0 else None
+                    )
+                except queue.Empty:
+                    item = threading.Event()
 
-    @staticmethod
-    def process_choices(choices, metadata):
+                if item is None:
+                    break
+
+                if isinstance(item, threading.Event):
+                    for f in files.values():
+                        f.flush()
+                    pending = 0
+                    item.set()
+                    continue
+
+                save_to_path, rows = item
+                if save_to_path not in files:
+                    files[save_to_path] = open(
+                        save_to_path, "ab", buffering=WRITE_BUFFER_SIZE
+                    )
+                files[save_to_path].write(b"\n".join(rows) + b"\n")
+                pending += len(rows)
+                if pending >= WRITE_BATCH_SIZE:
+                    for f in files.values():
+                        f.flush()
+                    pending = 0
+        except Exception as e:
+            # Raised from `_flush_writer` / `close`, in the thread of the requests
+            logger.error(f"Unable to write the augmented data: {e}")
+            self._writer_error = e
+        finally:
+            for f in files.values():
+                try:
+                    f.close()
+                except OSError as e:
+                    if self._writer_error is None:
+                        self._writer_error = e
+
+    def _raise_writer_error(self):
+        if self._writer_error is not None:
+            raise RuntimeError(
+                "The augmented data could not be written"
+            ) from self._writer_error
+
+    def _flush_writer(self):
+        """Blocks until all the rows sent to the writer thread are on disk"""
+        flushed = threading.Event()
+        self._writer_q.put(flushed)
+        while not flushed.wait(timeout=1):
+            if not self._writer_thread.is_alive():
+                self._raise_writer_error()
+                raise RuntimeError("The augmentation writer thread stopped")
+
+    def close(self):
+        """Writes the pending rows and stops the writer thread"""
+        self._writer_q.put(None)
+        self._writer_thread.join()
+        self._raise_writer_error()
+
+    def process_choices(self, choices, metadata):
+        rows = []
         for c in choices:
             if "message" in c:
                 if "content" in c["message"]:
-                    AugmentOpenAI._parse_response(c["message"]["content"], metadata)
+                    res = self._parse_response(c["message"]["content"], metadata)
+                    if res is not None:
+                        rows.append(orjson.dumps(res))
 
-    @staticmethod
-    def _process_response(result):
-        AugmentOpenAI.process_choices(result.choices, result.metadata)
+        if len(rows) == 0:
+            return
+
+        self._writer_q.put((metadata["save_to_path"], rows))
+
+        logger.info(
+            f"Data received successfully for {metadata['featured_tag']} "
+            f"({len(rows)} examples)"
+        )
+
+    def _process_response(self, result):
+        self.process_choices(result.choices, result.metadata)
 
     def _prepare_request(
         self,
@@ -80,7 +276,7 @@ class AugmentOpenAI:
         temperature,
         top_p,
         presence_penalty,
-        num_proc,
+        tags_index,
         model_key,
         save_to_path,
     ):
@@ -88,33 +284,44 @@ class AugmentOpenAI:
 
         logger.info(f"Augmenting {tag} with {missing_num} examples")
         # RAG: I select similar articles to provide them to the LLM
+        required_examples = missing_num
 
-        tmp_dset = dset.filter(
-            lambda x: any(np.isin([tag], x["meshMajor"])), num_proc=num_proc
-        )
+        # Each request returns `n_per_request` completions (`n` param),
+        # so we only need 1 existing example for every `n_per_request` to generate
+        examples_to_use = math.ceil(required_examples / self.n_per_request)
+
+        # The index already tells us which rows have the tag: no need to scan `dset`
+        tmp_dset = dset.select(tags_index.get(tag, [])[:examples_to_use])
 
         # abstracts_num = [i for i in range(len(tmp_dset))]
         # random.shuffle(abstracts_num)
 
-        required_examples = missing_num
-        existing_examples = min(required_examples, len(tmp_dset))
+        existing_examples = len(tmp_dset)
+        if existing_examples == 0:
+            logger.warning(f"No existing examples found for {tag}. Skipping...")
+            return
 
-        n_per_example = math.ceil(required_examples / existing_examples)
+        # Distributing the required examples among the requests, so that we don't
+        # generate (and pay for) more than `required_examples` completions
+        n_per_example, remainder = divmod(required_examples, existing_examples)
         logger.info(
             f"Augmenting {tag} with {required_examples} examples, "
             f"using {existing_examples} in RAG mode"
         )
 
+        tag_prompt = self._create_tag_prompt(tag)
+        abstracts = tmp_dset["abstractText"]
+        mesh_majors = tmp_dset["meshMajor"]
         for i in range(existing_examples):
-            abstract = tmp_dset["abstractText"][i]
-            tags = tmp_dset["meshMajor"][i]
+            abstract = abstracts[i]
+            tags = mesh_majors[i]
             data = {
                 "model": self.model_key,
-                "n": n_per_example,
+                "n": n_per_example + (1 if i < remainder else 0),
                 "temperature": temperature,
                 "top_p": top_p,
                 "presence_penalty": presence_penalty,
-                "messages": self._create_message(abstract, tag),
+                "messages": self._create_message(tag_prompt, abstract),
             }
 
             metadata = {
@@ -136,7 +343,7 @@ class AugmentOpenAI:
         temperature,
         top_p,
         presence_penalty,
-        num_proc,
+        tags_index,
         model_key,
         save_to_path,
     ):
@@ -151,14 +358,37 @@ class AugmentOpenAI:
                 temperature,
                 top_p,
                 presence_penalty,
-                num_proc,
+                tags_index,
                 model_key,
                 save_to_path,
             ):
+                self._request(data, metadata)
+
+    def _request(self, data, metadata):
+        cache_key, cached = self._process_cached_response(data, metadata)
+        if cached:
+            return
+
+        for attempt in range(self.max_attempts):
+            try:
                 chat_completion = openai.ChatCompletion.create(**data)
-                chat_completion.metadata = metadata
+            except openai.error.OpenAIError as e:
+                error = e
+                if not is_retryable(e):
+                    break
+                if attempt < self.max_attempts - 1:
+                    logger.info(
+                        f"Retrying request for {metadata['featured_tag']} "
+                        f"({attempt + 1}/{self.max_attempts}): {error}"
+                    )
+                    time.sleep(self._backoff(attempt))
+                continue
+            self._cache_response(cache_key, chat_completion)
+            chat_completion.metadata = metadata
+            self._process_response(chat_completion)
+            return
 
-                self._process_response(chat_completion)
+        self._save_failed_request(data, metadata, error)
 
     def generate(
         self,
@@ -169,15 +399,19 @@ class AugmentOpenAI:
         temperature=1.5,
         top_p=1,
         presence_penalty=0,
-        num_proc=os.cpu_count(),
+        tags_index=None,
     ):
+        if tags_index is None:
+            tags_index = build_tags_index(dset)
+
         self._make_requests(
             collect_concurrent_calls=collect_concurrent_calls,
             dset=dset,
             temperature=temperature,
             top_p=top_p,
             presence_penalty=presence_penalty,
-            num_proc=num_proc,
+            tags_index=tags_index,
             model_key=model_key,
             save_to_path=save_to_path,
         )
+        self._flush_writer()
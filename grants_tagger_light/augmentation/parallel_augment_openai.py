@@ -1,43 +1,126 @@
-import os
+import asyncio
+import time
 
+import openai
 from loguru import logger
-from openai_multi_client import OpenAIMultiClient
 
-from grants_tagger_light.augmentation.augment_openai import AugmentOpenAI
+from grants_tagger_light.augmentation.augment_openai import (
+    AugmentOpenAI,
+    build_tags_index,
+    is_retryable,
+)
 
 
 class ParallelAugmentOpenAI(AugmentOpenAI):
-    def __init__(self, prompt_template_path, model_key="gpt-3.5-turbo"):
-        super().__init__(prompt_template_path, model_key)
-        self.api = OpenAIMultiClient(
-            endpoint="chats", data_template={"model": self.model_key}
+    def __init__(
+        self,
+        prompt_template_path,
+        model_key="gpt-3.5-turbo",
+        n_per_request=5,
+        max_concurrent=16,
+        max_rpm=3500,
+        max_tpm=90000,
+        max_attempts=3,
+        cache_path=None,
+    ):
+        """Sends the requests to OpenAI concurrently using `asyncio`.
+        The number of requests in flight is bounded by `max_concurrent`, and the
+        requests/tokens sent per minute by `max_rpm` and `max_tpm`. Inspired by
+        https://github.com/openai/openai-cookbook/blob/main/examples/api_request_parallel_processor.py
+        """  # noqa
+        super().__init__(
+            prompt_template_path,
+            model_key,
+            n_per_request=n_per_request,
+            max_attempts=max_attempts,
+            cache_path=cache_path,
         )
+        self.max_concurrent = max_concurrent
+        self.max_rpm = max_rpm
+        self.max_tpm = max_tpm
+        self.available_request_capacity = max_rpm
+        self.available_token_capacity = max_tpm
+        self.last_update_time = time.monotonic()
 
     @staticmethod
-    def _process_response(result):
-        if result.failed:
-            logger.warning(
-                f"Failed to get augmentation for {result.metadata['featured_tag']}"
-            )
+    def _estimate_tokens(data):
+        # Rough estimation (~4 chars per token). We expect each completion to be
+        # as long as the example abstract sent in the prompt
+        prompt_tokens = sum(len(m["content"]) for m in data["messages"]) // 4
+        return prompt_tokens * (1 + data["n"])
+
+    def _update_capacity(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity + self.max_rpm * elapsed / 60.0,
+            self.max_rpm,
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity + self.max_tpm * elapsed / 60.0,
+            self.max_tpm,
+        )
+        self.last_update_time = now
+
+    async def _wait_for_capacity(self, num_tokens):
+        # A request bigger than the whole budget would wait forever
+        num_tokens = min(num_tokens, self.max_tpm)
+        while True:
+            self._update_capacity()
+            if (
+                self.available_request_capacity >= 1
+                and self.available_token_capacity >= num_tokens
+            ):
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= num_tokens
+                return
+            await asyncio.sleep(0.1)
+
+    async def _arequest(self, semaphore, data, metadata):
+        cache_key, cached = self._process_cached_response(data, metadata)
+        if cached:
             return
-        choices = result.response["choices"]
-        AugmentOpenAI.process_choices(choices, result.metadata)
 
-    def _make_requests(
+        num_tokens = self._estimate_tokens(data)
+        for attempt in range(self.max_attempts):
+            async with semaphore:
+                await self._wait_for_capacity(num_tokens)
+                try:
+                    chat_completion = await openai.ChatCompletion.acreate(**data)
+                except openai.error.OpenAIError as e:
+                    error = e
+                    if not is_retryable(e):
+                        break
+                else:
+                    self._cache_response(cache_key, chat_completion)
+                    chat_completion.metadata = metadata
+                    self._process_response(chat_completion)
+                    return
+
+            # Sleeping out of the semaphore, to let other requests go meanwhile
+            if attempt < self.max_attempts - 1:
+                logger.info(
+                    f"Retrying request for {metadata['featured_tag']} "
+                    f"({attempt + 1}/{self.max_attempts}): {error}"
+                )
+                await asyncio.sleep(self._backoff(attempt))
+
+        self._save_failed_request(data, metadata, error)
+
+    async def _make_requests(
         self,
         collect_concurrent_calls,
         dset,
         temperature,
         top_p,
         presence_penalty,
-        num_proc,
+        tags_index,
         model_key,
         save_to_path,
     ):
-        for num in range(len(collect_concurrent_calls)):
-            tag = collect_concurrent_calls[num][0]
-            missing_num = collect_concurrent_calls[num][1]
-
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        requests = []
+        for tag, missing_num in collect_concurrent_calls:
             for data, metadata in self._prepare_request(
                 tag,
                 missing_num,
@@ -45,13 +128,13 @@ class ParallelAugmentOpenAI(AugmentOpenAI):
                 temperature,
                 top_p,
                 presence_penalty,
-                num_proc,
+                tags_index,
                 model_key,
                 save_to_path,
             ):
-                self.api.request(
-                    data=data, metadata=metadata, callback=self._process_response
-                )
+                requests.append(self._arequest(semaphore, data, metadata))
+
+        await asyncio.gather(*requests)
 
     def generate(
         self,
@@ -62,18 +145,21 @@ class ParallelAugmentOpenAI(AugmentOpenAI):
         temperature=1.5,
         top_p=1,
         presence_penalty=0,
-        num_proc=os.cpu_count(),
+        tags_index=None,
     ):
-        self.api.run_request_function(
-            self._make_requests,
-            collect_concurrent_calls=collect_concurrent_calls,
-            dset=dset,
-            temperature=temperature,
-            top_p=top_p,
-            presence_penalty=presence_penalty,
-            num_proc=num_proc,
-            model_key=model_key,
-            save_to_path=save_to_path,
-        )
+        if tags_index is None:
+            tags_index = build_tags_index(dset)
 
-        self.api.pull_all()
+        asyncio.run(
+            self._make_requests(
+                collect_concurrent_calls=collect_concurrent_calls,
+                dset=dset,
+                temperature=temperature,
+                top_p=top_p,
+                presence_penalty=presence_penalty,
+                tags_index=tags_index,
+                model_key=model_key,
+                save_to_path=save_to_path,
+            )
+        )
+        self._flush_writer()
@@ -0,0 +1,39 @@
+import hashlib
+import json
+import sqlite3
+from collections import Counter
+
+
+class ResponseCache:
+    def __init__(self, cache_path):
+        """On-disk (sqlite) cache of the choices returned by OpenAI, so that
+        re-running the augmentation does not pay again for the same requests.
+
+        The same request can be sent several times in a run (e.g. duplicated
+        abstracts). As temperature makes every answer different, each occurrence
+        of the request is cached under a different key."""
+        self.connection = sqlite3.connect(cache_path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT)"
+        )
+        self.connection.commit()
+        self.occurrences = Counter()
+
+    def key(self, data):
+        request = json.dumps(data, sort_keys=True)
+        occurrence = self.occurrences[request]
+        self.occurrences[request] += 1
+        return hashlib.sha256(f"{occurrence}:{request}".encode()).hexdigest()
+
+    def get(self, key):
+        row = self.connection.execute(
+            "SELECT response FROM cache WHERE key=?", (key,)
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key, choices):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO cache (key, response) VALUES (?, ?)",
+            (key, json.dumps(choices)),
+        )
+        self.connection.commit()
@@ -12,10 +12,12 @@ class MultiLabelAttention(torch.nn.Module):
         self.A = torch.nn.Parameter(torch.empty(D_in, num_labels))
         torch.nn.init.uniform_(self.A, -0.1, 0.1)
 
-    def forward(self, x):
-        attention_weights = torch.nn.functional.softmax(
-            torch.tanh(torch.matmul(x, self.A)), dim=1
-        )
+    def forward(self, x, attention_mask=None):
+        scores = torch.tanh(torch.matmul(x, self.A))
+        if attention_mask is not None:
+            # Padding tokens should not get any attention
+            scores = scores.masked_fill(attention_mask.unsqueeze(-1) == 0, -1e4)
+        attention_weights = torch.nn.functional.softmax(scores, dim=1)
         return torch.matmul(torch.transpose(attention_weights, 2, 1), x)
 
 
@@ -37,6 +39,11 @@ class BertMesh(PreTrainedModel):
 
         self.multilabel_attention = getattr(self.config, "multilabel_attention", False)
 
+        # Models trained on dynamically padded batches mask the padding. Older
+        # checkpoints (e.g. `Wellcome/WellcomeBertMesh`) were trained on inputs
+        # padded to 512 tokens with no mask, so they keep ignoring it
+        self.use_attention_mask = getattr(self.config, "use_attention_mask", False)
+
         self.id2label = self.config.id2label
 
         self.bert = AutoModel.from_pretrained(self.pretrained_model)  # 768
@@ -64,20 +71,28 @@ class BertMesh(PreTrainedModel):
                 # logger.info(f"Unfreezing {name}")
                 param.requires_grad = True
 
-    def forward(self, input_ids, labels=None, **kwargs):
+    def forward(self, input_ids, attention_mask=None, labels=None, **kwargs):
         if isinstance(input_ids, list):
             # coming from tokenizer
             input_ids = torch.tensor(input_ids)
+        if not self.use_attention_mask:
+            attention_mask = None
+        elif isinstance(attention_mask, list):
+            attention_mask = torch.tensor(attention_mask)
 
         if self.multilabel_attention:
-            hidden_states = self.bert(input_ids=input_ids)[0]
-            attention_outs = self.multilabel_attention_layer(hidden_states)
+            hidden_states = self.bert(
+                input_ids=input_ids, attention_mask=attention_mask
+            )[0]
+            attention_outs = self.multilabel_attention_layer(
+                hidden_states, attention_mask=attention_mask
+            )
             outs = torch.nn.functional.relu(self.linear_1(attention_outs))
             outs = self.dropout_layer(outs)
             outs = self.linear_2(outs)
             outs = torch.flatten(outs, start_dim=1)
         else:
-            cls = self.bert(input_ids=input_ids)[1]
+            cls = self.bert(input_ids=input_ids, attention_mask=attention_mask)[1]
             outs = torch.nn.functional.relu(self.linear_1(cls))
             outs = self.dropout_layer(outs)
             outs = self.linear_out(outs)
@@ -16,16 +16,23 @@ class BertMeshPipeline(Pipeline):
         return preprocess_kwargs, forward_kwargs, postprocess_kwargs
 
     def preprocess(self, input_txt, **preprocess_kwargs):
-        return self.tokenizer(
+        # Models using the attention mask don't need padding up to `max_length`.
+        # The rest were trained with it, so we keep feeding them padded inputs
+        use_attention_mask = getattr(self.model.config, "use_attention_mask", False)
+        model_inputs = self.tokenizer(
             input_txt,
-            padding="max_length",
+            padding=False if use_attention_mask else "max_length",
             truncation=True,
             max_length=512,
             return_tensors="pt",
-        )["input_ids"].to(self.device)
+        )
+        return {
+            "input_ids": model_inputs["input_ids"].to(self.device),
+            "attention_mask": model_inputs["attention_mask"].to(self.device),
+        }
 
-    def _forward(self, input_ids, **forward_kwargs):
-        return self.model(input_ids)
+    def _forward(self, model_inputs, **forward_kwargs):
+        return self.model(**model_inputs)
 
     def postprocess(
         self,
@@ -1,28 +1,33 @@
+import hashlib
 import json
+import shutil
 import tempfile
 
 import typer
 import time
 from transformers import AutoTokenizer
-from datasets import load_dataset
+from datasets import load_dataset, load_from_disk
 from grants_tagger_light.models.bert_mesh import BertMesh
 import os
 from loguru import logger
-from tqdm import tqdm
-import numpy as np
+import pyarrow.compute as pc
 from datasets.dataset_dict import DatasetDict
 
 from grants_tagger_light.utils.years_tags_parser import parse_tags, parse_years
 
 preprocess_app = typer.Typer()
 
+DEFAULT_TOKENIZER_KEY = "microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract"
+MAX_LENGTH = 512
+
 
 def _tokenize(batch, tokenizer: AutoTokenizer, x_col: str):
+    # No padding: it's done dynamically per batch by `MultilabelDataCollator`
     return tokenizer(
         batch[x_col],
-        padding="max_length",
+        padding=False,
         truncation=True,
-        max_length=512,
+        max_length=MAX_LENGTH,
     )
 
 
@@ -34,8 +39,28 @@ def _encode_labels(sample, label2id):
     return {"label_ids": [_map_label_to_ids(x, label2id) for x in sample["meshMajor"]]}
 
 
+def _tokenize_and_encode_labels(batch, tokenizer: AutoTokenizer, x_col, label2id):
+    encoded = _tokenize(batch, tokenizer, x_col)
+    encoded.update(_encode_labels(batch, label2id))
+    return encoded
+
+
 def _filter_rows_by_years(sample, years):
-    return [x in years for x in sample["year"]]
+    return [str(x) in years for x in sample["year"]]
+
+
+def _filter_rows_by_tags(sample, tags):
+    return [not tags.isdisjoint(x) for x in sample["meshMajor"]]
+
+
+def _filter_rows(sample, years=None, tags=None):
+    """Years and tags filters in a single pass. `None` keeps all the rows"""
+    keep = [True] * len(sample["meshMajor"])
+    if years is not None:
+        keep = [k and f for k, f in zip(keep, _filter_rows_by_years(sample, years))]
+    if tags is not None:
+        keep = [k and f for k, f in zip(keep, _filter_rows_by_tags(sample, tags))]
+    return keep
 
 
 def create_sample_file(jsonl_file, lines):
@@ -50,6 +75,69 @@ def create_sample_file(jsonl_file, lines):
     return tmp_file.name
 
 
+def _preprocessing_fingerprint(data_path, model_key, **preprocessing_args):
+    """Hash of everything the result of `preprocess_mesh` depends on"""
+    stat = os.stat(data_path)
+    fingerprint = {
+        "data_path": os.path.abspath(data_path),
+        "data_size": stat.st_size,
+        "data_mtime": stat.st_mtime,
+        "tokenizer": model_key or DEFAULT_TOKENIZER_KEY,
+        "max_length": MAX_LENGTH,
+        **preprocessing_args,
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+def save_preprocessed(dset, label2id, id2label, save_to_path, num_proc):
+    dset.save_to_disk(os.path.join(save_to_path, "dataset"), num_proc=num_proc)
+    with open(os.path.join(save_to_path, "label2id"), "w") as f:
+        json.dump(label2id, f)
+    with open(os.path.join(save_to_path, "id2label"), "w") as f:
+        json.dump(id2label, f)
+
+
+def copy_preprocessed(from_path, to_path):
+    """Copies the output of `save_preprocessed`, instead of serializing it again"""
+    os.makedirs(to_path, exist_ok=True)
+    dataset_path = os.path.join(to_path, "dataset")
+    if os.path.isdir(dataset_path):
+        shutil.rmtree(dataset_path)
+    shutil.copytree(os.path.join(from_path, "dataset"), dataset_path)
+    for name in ("label2id", "id2label"):
+        shutil.copy(os.path.join(from_path, name), os.path.join(to_path, name))
+
+
+def _cache_preprocessed(dset, label2id, id2label, cache_path, num_proc, saved_path):
+    """Writes the cache in a temporary folder which is then renamed, so that an
+    interrupted run never leaves an incomplete `cache_path` behind"""
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp-")
+    try:
+        if saved_path is not None:
+            copy_preprocessed(saved_path, tmp_path)
+        else:
+            save_preprocessed(dset, label2id, id2label, tmp_path, num_proc)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        # e.g. another run with the same arguments cached it meanwhile
+        logger.warning(f"Unable to cache the preprocessed data: {e}")
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+
+
+def load_preprocessed(save_to_path):
+    dset = load_from_disk(os.path.join(save_to_path, "dataset"))
+    with open(os.path.join(save_to_path, "label2id"), "r") as f:
+        label2id = json.load(f)
+    with open(os.path.join(save_to_path, "id2label"), "r") as f:
+        # json only allows str keys
+        id2label = {int(k): v for k, v in json.load(f).items()}
+    return dset, label2id, id2label
+
+
 def preprocess_mesh(
     data_path: str,
     model_key: str,
@@ -61,7 +149,29 @@ def preprocess_mesh(
     tags: list = None,
     train_years: list = None,
     test_years: list = None,
+    cache_dir: str = None,
 ):
+    if cache_dir is not None:
+        cache_path = os.path.join(
+            cache_dir,
+            _preprocessing_fingerprint(
+                data_path,
+                model_key,
+                test_size=test_size,
+                max_samples=max_samples,
+                tags=tags,
+                train_years=train_years,
+                test_years=test_years,
+            ),
+        )
+        if os.path.isdir(cache_path):
+            logger.info(f"Loading the preprocessed data from cache: {cache_path}")
+            dset, label2id, id2label = load_preprocessed(cache_path)
+            if save_to_path is not None:
+                logger.info("Saving to disk...")
+                copy_preprocessed(cache_path, save_to_path)
+            return dset, label2id, id2label
+
     if max_samples != -1:
         logger.info(f"Filtering examples to {max_samples}")
         data_path = create_sample_file(data_path, max_samples)
@@ -69,9 +179,7 @@ def preprocess_mesh(
     if not model_key:
         label2id = None
         id2label = None
-        tokenizer = AutoTokenizer.from_pretrained(
-            "microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract"
-        )
+        tokenizer = AutoTokenizer.from_pretrained(DEFAULT_TOKENIZER_KEY)
     else:
         # Load the model to get its label2id
         tokenizer = AutoTokenizer.from_pretrained(model_key)
@@ -81,10 +189,9 @@ def preprocess_mesh(
         label2id = {v: k for k, v in id2label.items()}
 
     # We only have 1 file, so no sharding is available https://huggingface.co/docs/datasets/loading#multiprocessing
-    dset = load_dataset("json", data_files=data_path, num_proc=1)
-    # By default, any dataset loaded is set to 'train' using the previous command
-    if "train" in dset:
-        dset = dset["train"]
+    # Arrow's multithreaded json parser is used under the hood. By default, any
+    # dataset loaded is set to 'train', so we directly get that split
+    dset = load_dataset("json", data_files=data_path, split="train", num_proc=1)
 
     years = list()
     if train_years is not None and len(train_years) > 0:
@@ -92,72 +199,56 @@ def preprocess_mesh(
     if test_years is not None and len(test_years) > 0:
         years.extend(test_years)
 
-    if len(years) > 0:
-        logger.info(f"Removing all years which are not in {years}")
-        dset = dset.filter(
-            lambda x: any(np.isin(years, [str(x["year"])])), num_proc=num_proc
-        )
-
     if tags is None:
         tags = []
 
-    if len(tags) > 0:
-        logger.info(f"Removing all tags which are not in {tags}")
+    if len(years) > 0 or len(tags) > 0:
+        if len(years) > 0:
+            logger.info(f"Removing all years which are not in {years}")
+        if len(tags) > 0:
+            logger.info(f"Removing all tags which are not in {tags}")
         dset = dset.filter(
-            lambda x: any(np.isin(tags, x["meshMajor"])), num_proc=num_proc
+            _filter_rows,
+            batched=True,
+            batch_size=batch_size,
+            num_proc=num_proc,
+            fn_kwargs={
+                "years": set(years) if len(years) > 0 else None,
+                "tags": set(tags) if len(tags) > 0 else None,
+            },
         )
 
     # Remove unused columns to save space & time
     dset = dset.remove_columns(["journal", "pmid", "title"])
 
-    t1 = time.time()
-    dset = dset.map(
-        _tokenize,
-        batched=True,
-        batch_size=batch_size,
-        num_proc=num_proc,
-        desc="Tokenizing",
-        fn_kwargs={"tokenizer": tokenizer, "x_col": "abstractText"},
-    )
-    logger.info("Time taken to tokenize: {}".format(time.time() - t1))
-
     # Generate label2id if None
     if label2id is None:
-        logger.info("Getting the labels...")
-        dset = dset.map(
-            lambda x: {"meshMajor": x["meshMajor"]},
-            batched=True,
-            batch_size=batch_size,
-            num_proc=num_proc,
-            desc="Getting labels",
-        )
-
-        # Most efficient way to do dedup of labels
-        unique_labels_set = set()
-
         logger.info("Obtaining unique values from the labels...")
-        # Iterate through the lists and add elements to the set
-        for arr in tqdm(dset["meshMajor"]):
-            unique_labels_set.update(arr)
+        # Flattening and deduplicating the labels in Arrow, without converting to
+        # Python. The arrow format takes into account the filters applied before.
+        unique_labels = pc.unique(
+            pc.list_flatten(dset.with_format("arrow")["meshMajor"])
+        ).to_pylist()
 
-        # Most efficient way to do dictionary creation
         logger.info("Creating label2id dictionary...")
-        label2id = dict()
-        id2label = dict()
-        for idx, label in enumerate(tqdm(unique_labels_set)):
-            label2id.update({label: idx})
-            id2label.update({idx: label})
+        label2id = {label: idx for idx, label in enumerate(unique_labels)}
+        id2label = {idx: label for idx, label in enumerate(unique_labels)}
 
+    # Tokenizing and encoding the labels in the same pass over the data
     t1 = time.time()
     dset = dset.map(
-        _encode_labels,
+        _tokenize_and_encode_labels,
         batched=True,
         batch_size=batch_size,
-        desc="Encoding labels",
         num_proc=num_proc,
-        fn_kwargs={"label2id": label2id},
+        desc="Tokenizing and encoding labels",
+        fn_kwargs={
+            "tokenizer": tokenizer,
+            "x_col": "abstractText",
+            "label2id": label2id,
+        },
     )
-    logger.info("Time taken to encode labels: {}".format(time.time() - t1))
+    logger.info("Time taken to tokenize and encode labels: {}".format(time.time() - t1))
 
     logger.info("Preparing train/test split....")
     # Split into train and test
@@ -170,7 +261,7 @@ def preprocess_mesh(
             batch_size=batch_size,
             desc=f"Creating training dataset with years {train_years}",
             num_proc=num_proc,
-            fn_kwargs={"years": train_years},
+            fn_kwargs={"years": set(train_years)},
         )
         test_dset = dset.filter(
             _filter_rows_by_years,
@@ -178,7 +269,7 @@ def preprocess_mesh(
             batch_size=batch_size,
             desc=f"Creating test dataset with years {test_years}",
             num_proc=num_proc,
-            fn_kwargs={"years": test_years},
+            fn_kwargs={"years": set(test_years)},
         )
 
         if test_size is None or test_size == 1.0:
@@ -214,11 +305,13 @@ def preprocess_mesh(
     # on serializing the data # to disk if we are going to load it afterwards
     if save_to_path is not None:
         logger.info("Saving to disk...")
-        dset.save_to_disk(os.path.join(save_to_path, "dataset"), num_proc=num_proc)
-        with open(os.path.join(save_to_path, "label2id"), "w") as f:
-            json.dump(label2id, f)
-        with open(os.path.join(save_to_path, "id2label"), "w") as f:
-            json.dump(id2label, f)
+        save_preprocessed(dset, label2id, id2label, save_to_path, num_proc)
+
+    if cache_dir is not None:
+        logger.info(f"Caching the preprocessed data to {cache_path}...")
+        _cache_preprocessed(
+            dset, label2id, id2label, cache_path, num_proc, saved_path=save_to_path
+        )
 
     return dset, label2id, id2label
 
@@ -256,6 +349,11 @@ def preprocess_mesh_cli(
     test_years: str = typer.Option(
         None, help="Comma-separated years you want to include in the test dataset"
     ),
+    cache_dir: str = typer.Option(
+        None,
+        help="Folder to cache the preprocessed data. If the same data was already "
+        "preprocessed with the same arguments, it's loaded from there",
+    ),
 ):
     if not data_path.endswith("jsonl"):
         logger.error(
@@ -285,4 +383,5 @@ def preprocess_mesh_cli(
         tags=parse_tags(tags),
         train_years=parse_years(train_years),
         test_years=parse_years(test_years),
+        cache_dir=cache_dir,
     )
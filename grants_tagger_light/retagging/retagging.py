@@ -127,9 +127,7 @@ def retag(
 ):
     # We only have 1 file, so no sharding is available https://huggingface.co/docs/datasets/loading#multiprocessing
     logging.info("Loading the MeSH jsonl...")
-    dset = load_dataset("json", data_files=data_path, num_proc=1)
-    if "train" in dset:
-        dset = dset["train"]
+    dset = load_dataset("json", data_files=data_path, split="train", num_proc=1)
 
     if years is not None:
         logger.info(f"Removing all years which are not in {years}")
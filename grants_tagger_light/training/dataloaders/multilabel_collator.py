@@ -1,3 +1,4 @@
+import math
 from typing import List, Any, Mapping
 from sklearn.preprocessing import MultiLabelBinarizer
 import numpy as np
@@ -5,9 +6,31 @@ import torch
 
 
 class MultilabelDataCollator:
-    def __init__(self, label2id: dict):
+    def __init__(
+        self, label2id: dict, pad_token_id: int = 0, pad_to_multiple_of: int = None
+    ):
         self.mlb = MultiLabelBinarizer(classes=list(label2id.values()))
         self.mlb.fit([list(label2id.values())])
+        # Tokenized inputs come without padding, so we pad them to the longest
+        # sequence of the batch (rounded up to `pad_to_multiple_of`)
+        self.pad_values = {
+            "input_ids": pad_token_id,
+            "attention_mask": 0,
+            "token_type_ids": 0,
+        }
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def _pad(self, sequences, pad_value):
+        sequences = [s.tolist() if hasattr(s, "tolist") else list(s) for s in sequences]
+        max_length = max(len(s) for s in sequences)
+        if self.pad_to_multiple_of is not None:
+            max_length = (
+                math.ceil(max_length / self.pad_to_multiple_of)
+                * self.pad_to_multiple_of
+            )
+        return torch.tensor(
+            [s + [pad_value] * (max_length - len(s)) for s in sequences]
+        )
 
     def __call__(self, features: List[Any]):
         """
@@ -39,7 +62,9 @@ class MultilabelDataCollator:
                 and v is not None
                 and not isinstance(v, str)
             ):
-                if isinstance(v, torch.Tensor):
+                if k in self.pad_values:
+                    batch[k] = self._pad([f[k] for f in features], self.pad_values[k])
+                elif isinstance(v, torch.Tensor):
                     batch[k] = torch.stack([f[k] for f in features])
                 elif isinstance(v, np.ndarray):
                     batch[k] = torch.tensor(np.stack([f[k] for f in features]))
@@ -49,6 +49,7 @@ def train_bertmesh(
     tags: list = None,
     train_years: list = None,
     test_years: list = None,
+    cache_dir: str = None,
 ):
     if not model_key:
         assert isinstance(model_args, BertMeshModelArguments), (
@@ -79,6 +80,7 @@ def train_bertmesh(
             tags=tags,
             train_years=train_years,
             test_years=test_years,
+            cache_dir=cache_dir,
         )
 
     train_dset, val_dset = dset["train"], dset["test"]
@@ -126,6 +128,7 @@ def train_bertmesh(
                 "freeze_backbone": model_args.freeze_backbone,
                 "hidden_dropout_prob": model_args.hidden_dropout_prob,
                 "attention_probs_dropout_prob": model_args.attention_probs_dropout_prob,
+                "use_attention_mask": True,
             }
         )
         logger.info(f"Hidden size: {config.hidden_size}")
@@ -143,6 +146,10 @@ def train_bertmesh(
     else:
         logger.info(f"Training from pretrained key {model_key}")
         model = BertMesh.from_pretrained(model_key, trust_remote_code=True)
+        # Batches are padded dynamically by `MultilabelDataCollator`, so the padding
+        # has to be masked from now on (saved in the config of the new checkpoint)
+        model.config.use_attention_mask = True
+        model.use_attention_mask = True
 
     if model_args.freeze_backbone is None:
         model_args.freeze_backbone = "freeze"
@@ -193,7 +200,11 @@ def train_bertmesh(
         return metric_dict
 
     logger.info("Collating labels...")
-    collator = MultilabelDataCollator(label2id=label2id)
+    collator = MultilabelDataCollator(
+        label2id=label2id,
+        pad_token_id=model.config.pad_token_id or 0,
+        pad_to_multiple_of=8,
+    )
 
     if shards > 0:
         logger.info("Calculating max steps for IterableDatasets shards...")
@@ -323,6 +334,11 @@ def train_bertmesh_cli(
     test_years: str = typer.Option(
         None, help="Comma-separated years you want to include in the test dataset"
     ),
+    cache_dir: str = typer.Option(
+        None,
+        help="Folder to cache the data preprocessed on the fly. If the same data was "
+        "already preprocessed with the same arguments, it's loaded from there",
+    ),
 ):
     parser = HfArgumentParser(
         (
@@ -354,4 +370,5 @@ def train_bertmesh_cli(
         tags=parse_tags(tags),
         train_years=parse_years(train_years),
         test_years=parse_years(test_years),
+        cache_dir=cache_dir,
     )
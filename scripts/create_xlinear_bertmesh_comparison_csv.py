@@ -46,39 +46,42 @@ def find_subnames(mesh_metadata_path: str, mesh_terms_list_path: str):
         List[str]: A list of all MeSH terms that are subnames
                    of the MeSH terms in the input file.
     """
-    mesh_tree = ET.parse(mesh_metadata_path)
-    mesh_terms = load_mesh_terms_from_file(mesh_terms_list_path)
-    root = mesh_tree.getroot()
-
-    # Do 1st pass to get all their codes
-    top_level_tree_numbers = []
-    pbar = tqdm(root)
-    pbar.set_description("Finding top level tree numbers")
-    for mesh_elem in pbar:
-        try:
-            tree_number, _, name = _extract_data(mesh_elem)
-        except IndexError:
-            continue
-
-        if name not in mesh_terms:
+    mesh_terms = set(load_mesh_terms_from_file(mesh_terms_list_path))
+
+    # Stream the xml (instead of loading the whole tree in memory) in 1 pass,
+    # keeping only the tree numbers and names of the descriptors
+    descriptors = []
+    context = ET.iterparse(mesh_metadata_path, events=("start", "end"))
+    _, root = next(context)
+    pbar = tqdm(desc="Parsing MeSH descriptors")
+    for event, mesh_elem in context:
+        if event != "end" or mesh_elem.tag != "DescriptorRecord":
             continue
-        else:
-            top_level_tree_numbers.append(tree_number)
-
-    # Do 2nd pass to collect all names that are in the same tree as the ones we found
-    all_subnames = []
-    pbar = tqdm(root)
-    pbar.set_description("Finding subnames")
-    for mesh_elem in pbar:
         try:
-            curr_tree_number, _, name = _extract_data(mesh_elem)
+            descriptors.append(_extract_data(mesh_elem))
         except IndexError:
-            continue
-
-        for top_level_tree_number in top_level_tree_numbers:
-            if curr_tree_number.startswith(top_level_tree_number):
-                all_subnames.append(name)
-                break
+            pass
+        # Free the descriptors already processed
+        root.clear()
+        pbar.update(1)
+    pbar.close()
+
+    # Get the codes of all the terms in the list
+    top_level_tree_numbers = {
+        tree_number for tree_number, _, name in descriptors if name in mesh_terms
+    }
+    # Instead of checking `startswith` against every top level tree number,
+    # we look up the prefixes of each tree number with those lengths in the set
+    top_level_lengths = sorted({len(t) for t in top_level_tree_numbers})
+
+    # Collect all names that are in the same tree as the ones we found
+    all_subnames = []
+    for curr_tree_number, _, name in tqdm(descriptors, desc="Finding subnames"):
+        if any(
+            curr_tree_number[:length] in top_level_tree_numbers
+            for length in top_level_lengths
+        ):
+            all_subnames.append(name)
 
     return all_subnames
 
@@ -104,23 +107,21 @@ def create_comparison_csv(
     parquet_files = wr.s3.list_objects(s3_url)
     random.shuffle(parquet_files)
 
-    grants = []
-
-    for idx in tqdm(range(num_parquet_files_to_consider)):
-        grants.append(
-            wr.s3.read_parquet(
-                parquet_files[idx],
-            )
-        )
-
-    all_grants = pd.concat(grants)
+    # Read all the files at once, in parallel
+    all_grants = wr.s3.read_parquet(
+        path=parquet_files[:num_parquet_files_to_consider],
+        use_threads=True,
+    )
 
     # Filter out rows where abstract is na
     all_grants = all_grants[~all_grants["abstract"].isna()]
 
     # Do stratified sampling based on for_first_level_name column
-    grants_sample = all_grants.groupby("for_first_level_name", group_keys=False).apply(
-        lambda x: x.sample(min(len(x), num_samples_per_cat))
+    # (shuffling and taking the first rows of each category)
+    grants_sample = (
+        all_grants.sample(frac=1)
+        .groupby("for_first_level_name", group_keys=False)
+        .head(num_samples_per_cat)
     )
     grants_sample["active_portfolio"] = 0
 
@@ -1,6 +1,7 @@
 import json
 from argparse import ArgumentParser
 import numpy as np
+import orjson
 from loguru import logger
 
 
@@ -73,11 +74,13 @@ def mesh_json_to_jsonl(
                     logger.info(f"Skipping first line (articles): {line}")
                     continue
                 try:
-                    sample = json.loads(line[:-2])
-                except json.JSONDecodeError:
+                    sample = orjson.loads(line[:-2])
+                except orjson.JSONDecodeError:
                     logger.warning(f"Skipping line in bad json format: {line}")
                     continue
                 if process_data(sample, filter_tags_list, filter_years_list):
+                    # Not `orjson.dumps`: it returns utf-8, and json.dumps escapes
+                    # the non-ascii chars so they are valid in `output_encoding`
                     fw.write(json.dumps(sample))
                     fw.write("\n")
 
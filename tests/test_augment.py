@@ -1,10 +1,20 @@
+import json
 import logging
 import os
 import tempfile
 import unittest
+from unittest import mock
+
+import openai
 import pytest
+from datasets import Dataset
 
 from grants_tagger_light.augmentation.augment import augment
+from grants_tagger_light.augmentation.augment_openai import AugmentOpenAI
+from grants_tagger_light.augmentation.parallel_augment_openai import (
+    ParallelAugmentOpenAI,
+)
+from grants_tagger_light.augmentation.response_cache import ResponseCache
 from grants_tagger_light.preprocessing.preprocess_mesh import preprocess_mesh
 
 # Note dummy data is not necessarily annotated correctly
@@ -70,5 +80,132 @@ def test_augment(data_path):
         logging.info(f.read())
 
 
+def test_response_cache():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache_path = tmpdirname + "/cache.sqlite"
+        data = {"model": "gpt-3.5-turbo", "n": 1, "messages": [{"content": "a"}]}
+        choices = [{"message": {"content": "response"}}]
+
+        cache = ResponseCache(cache_path)
+        first_key = cache.key(data)
+        # Same request sent twice in the same run gets a different key
+        second_key = cache.key(data)
+        assert first_key != second_key
+        assert cache.get(first_key) is None
+        cache.set(first_key, choices)
+
+        # A new run finds the response of the first occurrence
+        cache = ResponseCache(cache_path)
+        assert cache.get(cache.key(data)) == choices
+        assert cache.get(cache.key(data)) is None
+
+
+def test_augment_openai_writer():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        save_to_path = tmpdirname + "/augmented.jsonl"
+        metadata = {
+            "featured_tag": "Malaria",
+            "tags": ["Malaria"],
+            "required_examples": 2,
+            "existing_example": "This is an article about malaria",
+            "year": 2023,
+            "model_key": "gpt-3.5-turbo",
+            "save_to_path": save_to_path,
+        }
+        choices = [
+            {"message": {"content": '{"abstract": "New abstract", "title": "T"}'}},
+            {"message": {"content": "not a json"}},
+        ]
+
+        openai = AugmentOpenAI("grants_tagger_light/augmentation/prompt.template")
+        openai.process_choices(choices, metadata)
+        openai.process_choices(choices, metadata)
+        openai.close()
+
+        with open(save_to_path, "r") as f:
+            rows = [json.loads(line) for line in f]
+        assert len(rows) == 2
+        assert rows[0]["abstractText"] == "New abstract"
+        assert rows[0]["featured_tag"] == "Malaria"
+
+        # Errors writing the rows are not silently lost
+        metadata["save_to_path"] = tmpdirname + "/missing_folder/augmented.jsonl"
+        openai = AugmentOpenAI("grants_tagger_light/augmentation/prompt.template")
+        openai.process_choices(choices, metadata)
+        with pytest.raises(RuntimeError):
+            openai._flush_writer()
+        with pytest.raises(RuntimeError):
+            openai.close()
+
+
+def _chat_completion(content):
+    return openai.openai_object.OpenAIObject.construct_from(
+        {"choices": [{"message": {"content": content}}]}
+    )
+
+
+def _augment_with_errors(cls, side_effect, patched):
+    """Generates 1 example of `Malaria`, with `patched` (`create` or `acreate`)
+    raising/returning `side_effect`. Returns the mock, the rows and failed rows"""
+    dset = Dataset.from_list(
+        [{"abstractText": "This is an article about malaria", "meshMajor": ["Malaria"]}]
+    )
+    response = _chat_completion('{"abstract": "New abstract", "title": "T"}')
+    side_effect = [response if e is None else e for e in side_effect]
+    mock_cls = mock.AsyncMock if patched == "acreate" else mock.Mock
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        save_to_path = tmpdirname + "/augmented.jsonl"
+        with mock.patch.object(
+            openai.ChatCompletion, patched, mock_cls(side_effect=side_effect)
+        ) as request, mock.patch.object(AugmentOpenAI, "_backoff", return_value=0):
+            augment_openai = cls("grants_tagger_light/augmentation/prompt.template")
+            augment_openai.generate([("Malaria", 1)], dset, save_to_path, "gpt-4")
+            augment_openai.close()
+
+        rows, failed = [], []
+        for path, lines in ((save_to_path, rows), (f"{save_to_path}.failed", failed)):
+            if os.path.isfile(path):
+                with open(path, "r") as f:
+                    lines.extend(json.loads(line) for line in f)
+        return request, rows, failed
+
+
+@pytest.mark.parametrize(
+    "cls, patched",
+    [(AugmentOpenAI, "create"), (ParallelAugmentOpenAI, "acreate")],
+)
+def test_augment_openai_retries(cls, patched):
+    # 500/502 are raised as plain `APIError`, and are retried as 503 is
+    request, rows, failed = _augment_with_errors(
+        cls,
+        [
+            openai.error.APIError("Bad gateway", http_status=502),
+            openai.error.RateLimitError("Rate limit"),
+            None,
+        ],
+        patched,
+    )
+    assert request.call_count == 3
+    assert len(rows) == 1
+    assert len(failed) == 0
+
+    # Non transient errors are not retried
+    request, rows, failed = _augment_with_errors(
+        cls, [openai.error.APIError("Bad request", http_status=400)], patched
+    )
+    assert request.call_count == 1
+    assert len(rows) == 0
+    assert len(failed) == 1
+    assert failed[0]["featured_tag"] == "Malaria"
+
+    # The request is saved as failed after `max_attempts`
+    request, rows, failed = _augment_with_errors(
+        cls, [openai.error.Timeout("Timeout")] * 3, patched
+    )
+    assert request.call_count == 3
+    assert len(rows) == 0
+    assert len(failed) == 1
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,17 @@
+from grants_tagger_light.training.dataloaders import MultilabelDataCollator
+
+
+def test_multilabel_collator_pads_dynamically():
+    collator = MultilabelDataCollator(
+        label2id={"T1": 0, "T2": 1, "T3": 2}, pad_token_id=0, pad_to_multiple_of=4
+    )
+    features = [
+        {"input_ids": [2, 5, 6, 3], "attention_mask": [1, 1, 1, 1], "label_ids": [0]},
+        {"input_ids": [2, 7, 8, 9, 3], "attention_mask": [1] * 5, "label_ids": [1, 2]},
+    ]
+    batch = collator(features)
+
+    assert batch["input_ids"].shape == (2, 8)
+    assert batch["input_ids"][0].tolist() == [2, 5, 6, 3, 0, 0, 0, 0]
+    assert batch["attention_mask"][1].tolist() == [1, 1, 1, 1, 1, 0, 0, 0]
+    assert batch["labels"].tolist() == [[1, 0, 0], [0, 1, 1]]
@@ -1,4 +1,8 @@
-from transformers import pipeline
+import tempfile
+
+import pytest
+import torch
+from transformers import BertConfig, BertModel, pipeline
 from transformers.pipelines import PIPELINE_REGISTRY
 from grants_tagger_light.models.bert_mesh import BertMesh, BertMeshPipeline
 
@@ -13,3 +17,43 @@ def test_pipeline():
     out = pipe("This grant is about malaria")
     assert "Malaria" in out[0]
     assert "Neoplasms" not in out[0]
+
+
+@pytest.mark.parametrize("use_attention_mask", [False, True])
+def test_bert_mesh_attention_mask(use_attention_mask):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        # Tiny backbone (`MultiLabelAttention` expects 768 hidden units)
+        BertModel(
+            BertConfig(
+                vocab_size=32,
+                hidden_size=768,
+                num_hidden_layers=1,
+                num_attention_heads=1,
+                intermediate_size=8,
+            )
+        ).save_pretrained(tmpdirname)
+        config = BertConfig.from_pretrained(tmpdirname)
+        config.update(
+            {
+                "pretrained_model": tmpdirname,
+                "num_labels": 2,
+                "hidden_size": 16,
+                "multilabel_attention": True,
+                "use_attention_mask": use_attention_mask,
+            }
+        )
+        model = BertMesh(config).eval()
+
+    input_ids = torch.tensor([[2, 5, 6, 3, 0, 0], [2, 7, 8, 9, 10, 3]])
+    attention_mask = torch.tensor([[1, 1, 1, 1, 0, 0], [1, 1, 1, 1, 1, 1]])
+    with torch.no_grad():
+        padded = model(input_ids, attention_mask=attention_mask).logits[0]
+        unpadded = model(input_ids[:1, :4], attention_mask=attention_mask[:1, :4])
+        no_mask = model(input_ids).logits[0]
+
+    if use_attention_mask:
+        # Padding does not change the predictions
+        assert torch.allclose(padded, unpadded.logits[0], atol=1e-5)
+    else:
+        # Checkpoints without the flag ignore the mask, as they were trained
+        assert torch.equal(padded, no_mask)
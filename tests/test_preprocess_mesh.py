@@ -1,9 +1,17 @@
 import json
+import os
 import tempfile
 
 from grants_tagger_light.preprocessing.preprocess_mesh import (
     preprocess_mesh,
+    _filter_rows_by_years,
+    _filter_rows_by_tags,
+    _filter_rows,
+    _preprocessing_fingerprint,
+    _cache_preprocessed,
+    load_preprocessed,
 )
+from datasets import Dataset, DatasetDict
 from scripts.mesh_json_to_jsonl import process_data, mesh_json_to_jsonl
 import pytest
 
@@ -79,6 +87,18 @@ def test_process_data_with_filter_years_and_tags():
     assert process_data(item, filter_years=["2020"], filter_tags=["T3"]) is False
 
 
+def test_filter_rows_by_years_and_tags():
+    sample = {"year": [2018, "2020"], "meshMajor": [["T1", "T2"], ["T3"]]}
+    assert _filter_rows_by_years(sample, years={"2018"}) == [True, False]
+    assert _filter_rows_by_years(sample, years={"2020", "2021"}) == [False, True]
+    assert _filter_rows_by_tags(sample, tags={"T2", "T4"}) == [True, False]
+    assert _filter_rows_by_tags(sample, tags={"T4"}) == [False, False]
+    assert _filter_rows(sample, years={"2018"}, tags={"T3"}) == [False, False]
+    assert _filter_rows(sample, years={"2018", "2020"}, tags={"T3"}) == [False, True]
+    assert _filter_rows(sample, tags={"T1"}) == [True, False]
+    assert _filter_rows(sample) == [True, True]
+
+
 def test_json_to_jsonl(json_data_path):
     output_tmp = tempfile.NamedTemporaryFile(mode="w")
     mesh_json_to_jsonl(json_data_path, output_tmp.name, show_progress=False)
@@ -99,3 +119,28 @@ def test_preprocess_mesh(jsonl_data_path):
     assert len(dset["train"]) == 1
     assert len(dset["test"]) == 1
     assert len(list(label2id.keys())) == 3
+
+
+def test_preprocessing_fingerprint(jsonl_data_path):
+    fingerprint = _preprocessing_fingerprint(jsonl_data_path, "", test_size=0.5)
+    assert fingerprint == _preprocessing_fingerprint(jsonl_data_path, "", test_size=0.5)
+    assert fingerprint != _preprocessing_fingerprint(jsonl_data_path, "", test_size=0.2)
+    with open(jsonl_data_path, "a") as f:
+        f.write("\n")
+    assert fingerprint != _preprocessing_fingerprint(jsonl_data_path, "", test_size=0.5)
+
+
+def test_cache_preprocessed():
+    dset = DatasetDict({"train": Dataset.from_dict({"label_ids": [[0], [1]]})})
+    label2id = {"T1": 0, "T2": 1}
+    id2label = {0: "T1", 1: "T2"}
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache_path = tmpdirname + "/cache/fingerprint"
+        _cache_preprocessed(dset, label2id, id2label, cache_path, 1, saved_path=None)
+        # Only the final folder is left in the cache
+        assert os.listdir(tmpdirname + "/cache") == ["fingerprint"]
+
+        cached_dset, cached_label2id, cached_id2label = load_preprocessed(cache_path)
+        assert cached_dset["train"]["label_ids"] == [[0], [1]]
+        assert cached_label2id == label2id
+        assert cached_id2label == id2label